@@ -5,23 +5,164 @@ Builds Kalico firmware for multiple targets with permutations
 """
 
 import argparse
+import hashlib
 import json
 import os
+import re
+import shlex
 import shutil
+import string
 import subprocess
 import sys
+from collections import ChainMap, deque
+from collections.abc import Callable, Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import suppress
 from datetime import UTC, datetime
-from itertools import product
+from functools import cached_property
+from itertools import chain, islice, product
 from pathlib import Path
-from typing import Any
+from typing import Any, NamedTuple
+from urllib.parse import quote
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON, using orjson when it is installed"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(data: Any) -> bytes:
+    """Serialize JSON indented by two spaces with a trailing newline, using orjson when it is installed"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(data, indent=2, ensure_ascii=False) + "\n").encode()
+
+
+def _version_key(build: dict[str, Any]) -> tuple[str | int, ...]:
+    """Sort key ordering build versions numerically, so v0.12.0-124 sorts after v0.12.0-9"""
+    # Splitting on digit runs alternates text and numbers, so keys always compare like with like
+    return tuple(int(part) if i % 2 else part for i, part in enumerate(re.split(r"(\d+)", build.get("version", ""))))
+
+
+def _fast_copy(src: Path, dst: Path):
+    """Copy file contents in the kernel with copy_file_range (a reflink where the filesystem supports it)"""
+    if hasattr(os, "copy_file_range"):
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+                    pass
+                return
+            except OSError:
+                # Unsupported by this kernel or filesystem pair; copy it the portable way below
+                pass
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    shutil.copyfile(src, dst)
+
+
+def _write_atomic(path: Path, data: bytes):
+    """Write a file via a temporary file and rename, so readers never see it half-written"""
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _positive_int(value: str) -> int:
+    """argparse type accepting only integers greater than zero"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value!r}")
+    return number
+
+
+def _install_file(src: Path, dst: Path):
+    """Copy src over dst via a temporary file, replacing dst itself even if it is a symlink"""
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    try:
+        _fast_copy(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class TargetTemplates(NamedTuple):
+    """Filename templates and base format parameters of a target, resolved once per target"""
+
+    kconfig: dict[str, Callable[[Mapping[str, Any]], str]]
+    firmware: dict[str, Callable[[Mapping[str, Any]], str]]
+    params: dict[str, Any]
+
+
+class BuildJob(NamedTuple):
+    """A kconfig to compile in one build directory, the outputs it produces and where to cache the result"""
+
+    kconfig_path: Path
+    firmware_type: str
+    output_paths: list[Path]
+    cached_path: Path | None
+
+
+class UploadItem(NamedTuple):
+    """A local file to sync to S3, uploaded directly or copied server-side from copy_source"""
+
+    file_path: Path
+    s3_key: str
+    content_type: str
+    file_size: int
+    copy_source: str | None
+
 
 class KalicoBuilder:
     S3_BUCKET = "kalico-flasher"
     CLOUDFRONT_DISTRIBUTION_ID = "E12YCK1HLQNF8F"
+    # CloudFront caps in-progress invalidations at 3000 individual paths
+    CLOUDFRONT_MAX_PATHS = 3000
+    # Seconds between checks for finished permutations while make runs
+    BUILD_POLL_INTERVAL = 0.5
+    # Lines of a failed build's log (or of make's own errors) shown
+    ERROR_TAIL_LINES = 40
+    # Images each firmware type's build may produce, in order of preference
+    FIRMWARE_OUTPUTS = {
+        "kalico": ("klipper.bin", "klipper.elf", "klipper.uf2"),
+        "katapult": ("deployer.bin", "deployer.elf", "deployer.uf2"),
+    }
+    # S3 content type by file extension; anything else is served as application/octet-stream
+    CONTENT_TYPES = {
+        ".json": "application/json",
+        ".bin": "application/octet-stream",
+        ".elf": "application/octet-stream",
+        ".uf2": "application/octet-stream",
+        ".hex": "application/octet-stream",
+        ".png": "image/png",
+        ".jpg": "image/jpeg",
+        ".jpeg": "image/jpeg",
+        ".gif": "image/gif",
+        ".svg": "image/svg+xml",
+        ".webp": "image/webp",
+    }
+    S3_UPLOAD_WORKERS = 32
+    SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
 
     def __init__(self, root_dir: str):
         self.root_dir = Path(root_dir)
@@ -30,153 +171,395 @@ class KalicoBuilder:
         self.kconfigs_dir = self.root_dir / "kconfigs"
         self.images_dir = self.root_dir / "images"
         self.builds_dir = self.root_dir / "builds"
+        # Content-addressed store holding each distinct firmware image once; builds/<version>/ symlinks into it
+        self.objects_dir = self.builds_dir / ".objects"
+        # Out-of-tree build directories, shared by every version so objects survive between them
+        self.obj_cache_dir = self.builds_dir / ".obj_cache"
         self.firmware_types = ["kalico", "katapult"]
+        self._jobs = str(os.cpu_count() or 1)
+        self.ccache = shutil.which("ccache")
+        self.ccache_dir = self.root_dir / ".ccache"
+        self.artifact_cache = self.root_dir / ".artifact-cache"
+        # Source commits and compiler versions keying the artifact cache, captured once per build
+        self.source_revisions: dict[str, str] = {}
+        self.toolchain_version = ""
+        self._index_template: dict[str, Any] | None = None
+        self._index: dict[str, Any] | None = None
+        self._index_mtime = 0
+        # Filename templates parsed into formatting functions, keyed by template string
+        self._formatter_cache: dict[str, Callable[[Mapping[str, Any]], str]] = {}
+        # Contents of each kconfig read so far; cache keys, build directories and .config all need them
+        self._kconfig_contents: dict[Path, bytes] = {}
 
     def load_index_template(self) -> dict[str, Any]:
-        """Load the index-template.json file"""
-        with open(self.index_template_file) as f:
-            return json.load(f)
+        """Load the index-template.json file (parsed once; treat the result as read-only)"""
+        if self._index_template is None:
+            self._index_template = _json_loads(self.index_template_file.read_bytes())
+        return self._index_template
 
     def load_index(self) -> dict[str, Any]:
-        """Load or generate index.json from template"""
+        """Load or generate index.json from template, re-reading it only when it changed on disk"""
         if not self.index_file.exists():
-            # Generate from template if doesn't exist
+            # Generate from template if doesn't exist; the builds list is copied since save_index
+            # caches the index and callers append to it, while the memoized template is shared
             template = self.load_index_template()
-            self.save_index(template)
-
-        with open(self.index_file) as f:
-            return json.load(f)
+            return self.save_index({**template, "builds": list(template.get("builds", []))})
 
-    def save_index(self, data: dict[str, Any]):
-        """Save the index.json file"""
-        with open(self.index_file, "w") as f:
-            json.dump(data, f, indent=4)
-            f.write("\n")
+        mtime = self.index_file.stat().st_mtime_ns
+        if self._index is None or mtime != self._index_mtime:
+            self._index = _json_loads(self.index_file.read_bytes())
+            self._index_mtime = mtime
+        return self._index
 
-    def generate_permutations(self, target: dict[str, Any]) -> list[dict[str, str]]:
-        """Generate all permutation combinations for a target"""
+    def _load_builds(self) -> list[dict[str, Any]]:
+        """Builds array of index.json without generating or caching the whole index"""
+        if not self.index_file.exists():
+            return []
+        if self._index is not None and self.index_file.stat().st_mtime_ns == self._index_mtime:
+            return self._index.get("builds", [])
+        return _json_loads(self.index_file.read_bytes()).get("builds", [])
+
+    def save_index(self, data: dict[str, Any]) -> dict[str, Any]:
+        """Save the index.json file and keep it cached, so the next load_index doesn't re-read it"""
+        _write_atomic(self.index_file, _json_dumps(data))
+        self._index = data
+        self._index_mtime = self.index_file.stat().st_mtime_ns
+        return data
+
+    def generate_permutations(self, target: dict[str, Any]) -> Iterator[dict[str, str]]:
+        """Lazily generate all permutation combinations for a target"""
         config = target.get("configuration", {})
         permutations = config.get("permutations", {})
 
         if not permutations:
-            return [{}]
+            return iter([{}])
 
         # Get all permutation keys and their values
         keys = list(permutations.keys())
         values = [permutations[key] for key in keys]
 
-        # Generate all combinations
-        combinations = []
-        for combo in product(*values):
-            combinations.append(dict(zip(keys, combo, strict=True)))
-
-        return combinations
+        # Yield combinations one at a time; callers that need a list can call list() on it
+        return (dict(zip(keys, combo, strict=True)) for combo in product(*values))
+
+    def _formatter(self, template: str) -> Callable[[Mapping[str, Any]], str]:
+        """Function formatting a template, with its braces parsed once and cached"""
+        formatter = self._formatter_cache.get(template)
+        if formatter is None:
+            parsed = list(string.Formatter().parse(template))
+            if all(
+                field is None or (field.isidentifier() and not spec and not conversion)
+                for _, field, spec, conversion in parsed
+            ):
+                parts = [(literal, field) for literal, field, _, _ in parsed]
+
+                def formatter(params: Mapping[str, Any]) -> str:
+                    return "".join(
+                        literal if field is None else literal + str(params[field]) for literal, field in parts
+                    )
 
-    def format_filename(self, template: str, target: dict[str, Any], permutation: dict[str, str]) -> str:
-        """Format a filename using the template and permutation values"""
-        params = {
-            "targetId": target.get("targetId"),
-            "vendorId": target.get("vendorId"),
-            **permutation,
-        }
-        return template.format(**params)
+            else:
+                # Positional, indexed or formatted fields are left to str.format_map
+                formatter = template.format_map
+            self._formatter_cache[template] = formatter
+        return formatter
 
     def _get_template(self, config: dict[str, Any], primary_key: str, fallback_key: str, default: str) -> str:
         """Get template from config with fallback support"""
         return config.get(primary_key) or config.get(fallback_key) or default
 
-    def get_kconfig_filename(
-        self, target: dict[str, Any], permutation: dict[str, str], firmware_type: str = "kalico"
-    ) -> str:
-        """Get the kconfig filename for a target and permutation"""
-        config = target.get("configuration", {})
+    def _kconfig_template(self, config: dict[str, Any], firmware_type: str) -> str:
+        """Kconfig filename template of a target configuration"""
         # Try new naming convention first: kalicoKconfigFilenameTemplate, katapultKconfigFilenameTemplate
         template_key = f"{firmware_type}KconfigFilenameTemplate"
         # Fallback to old naming conventions
         fallback_key = "kconfigFilenameTemplate" if firmware_type == "kalico" else None
-        template = self._get_template(
+        return self._get_template(
             config,
             template_key,
             fallback_key or template_key,
             "{targetId}_{vendorId}.kconfig",
         )
-        return self.format_filename(template, target, permutation)
-
-    def get_firmware_filename(
-        self, target: dict[str, Any], permutation: dict[str, str], firmware_type: str = "kalico"
-    ) -> str:
-        """Get the firmware filename for a target and permutation"""
-        config = target.get("configuration", {})
 
+    def _firmware_template(self, config: dict[str, Any], firmware_type: str) -> str:
+        """Firmware filename template of a target configuration"""
         # For Kalico, use firmwareFilenameTemplate
         if firmware_type == "kalico":
-            template = self._get_template(
+            return self._get_template(
                 config,
                 "firmwareFilenameTemplate",
                 "fileTemplate",
                 "{targetId}_{vendorId}.bin",
             )
-        else:
-            # For Katapult, derive from katapultFilenameTemplate by replacing .kconfig with .bin
-            kconfig_template = config.get(f"{firmware_type}FilenameTemplate", "")
-            if kconfig_template:
-                template = kconfig_template.replace(".kconfig", ".bin")
-            else:
-                template = "{targetId}_{vendorId}.bin"
 
-        return self.format_filename(template, target, permutation)
+        # For Katapult, derive from katapultFilenameTemplate by replacing .kconfig with .bin
+        kconfig_template = config.get(f"{firmware_type}FilenameTemplate", "")
+        if kconfig_template:
+            return kconfig_template.replace(".kconfig", ".bin")
+        return "{targetId}_{vendorId}.bin"
 
-    def compile_firmware(
+    def _prepare_target(self, target: dict[str, Any]) -> TargetTemplates:
+        """Resolve a target's filename templates once, outside its permutation loop"""
+        config = target.get("configuration", {})
+        return TargetTemplates(
+            kconfig={
+                firmware_type: self._formatter(self._kconfig_template(config, firmware_type))
+                for firmware_type in self.firmware_types
+            },
+            firmware={
+                firmware_type: self._formatter(self._firmware_template(config, firmware_type))
+                for firmware_type in self.firmware_types
+            },
+            params={"targetId": target.get("targetId"), "vendorId": target.get("vendorId")},
+        )
+
+    def _make_env(self) -> dict[str, str]:
+        """Environment for make, pointing ccache at the persistent cache directory"""
+        env = os.environ.copy()
+        if self.ccache:
+            env["CCACHE_DIR"] = str(self.ccache_dir.resolve())
+            # Hash the compiler binary itself rather than its mtime, and ignore
+            # __TIME__/__FILE__ so rewritten headers still hit the cache
+            env["CCACHE_COMPILERCHECK"] = "content"
+            env["CCACHE_SLOPPINESS"] = "time_macros,file_macro"
+        return env
+
+    def _make_vars(self) -> list[str]:
+        """Make variable overrides that wrap the (cross) compiler with ccache"""
+        if not self.ccache:
+            return []
+        # CROSS_PREFIX is set by the arch Makefile, so defer its expansion to make
+        return [f"CC={self.ccache} $(CROSS_PREFIX)gcc"]
+
+    def _scan_dir(self, directory: Path, files_only: bool = False) -> frozenset[str]:
+        """Names of the entries (or only the files) in a directory, read with a single directory scan"""
+        if not directory.is_dir():
+            return frozenset()
+        with os.scandir(directory) as entries:
+            return frozenset(entry.name for entry in entries if not files_only or entry.is_file())
+
+    @cached_property
+    def kconfig_names(self) -> frozenset[str]:
+        """Names of all files in kconfigs/, scanned once per builder and shared by build and validate"""
+        return self._scan_dir(self.kconfigs_dir, files_only=True)
+
+    def _source_revision(self, source_dir: Path) -> str | None:
+        """Commit SHA of a source tree, or None if it is not a clean git checkout"""
+        try:
+            head = subprocess.run(
+                ["git", "-C", str(source_dir), "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+            ).stdout.strip()
+            dirty = subprocess.run(
+                ["git", "-C", str(source_dir), "status", "--porcelain", "--untracked-files=no"],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return None if dirty else head
+
+    def _toolchain_version(self) -> str:
+        """First line of --version of every compiler Kalico and Katapult may build with"""
+        versions = []
+        for compiler in ("arm-none-eabi-gcc", "avr-gcc", "gcc"):
+            if shutil.which(compiler):
+                result = subprocess.run([compiler, "--version"], capture_output=True, text=True)
+                versions.append(result.stdout.partition("\n")[0])
+        return "\n".join(versions)
+
+    def _read_kconfig(self, kconfig_path: Path) -> bytes:
+        """Contents of a kconfig, read from disk once per builder"""
+        contents = self._kconfig_contents.get(kconfig_path)
+        if contents is None:
+            contents = self._kconfig_contents[kconfig_path] = kconfig_path.read_bytes()
+        return contents
+
+    def _artifact_key(self, kconfig_path: Path, firmware_type: str) -> str | None:
+        """Cache key for a firmware artifact: kconfig contents, source commit and toolchain"""
+        revision = self.source_revisions.get(firmware_type)
+        if not revision:
+            return None
+        key = self._read_kconfig(kconfig_path) + revision.encode() + self.toolchain_version.encode()
+        return hashlib.sha256(key).hexdigest()
+
+    def _cached_artifact(self, kconfig_path: Path, firmware_type: str) -> Path | None:
+        """Path a kconfig's firmware is cached at, or None if its source tree is not cacheable"""
+        cache_key = self._artifact_key(kconfig_path, firmware_type)
+        return self.artifact_cache / cache_key if cache_key else None
+
+    def _build_dir(self, kconfig_path: Path, firmware_type: str, source_dir: Path) -> Path:
+        """Out-of-tree build directory for a kconfig, keyed by its contents and the source tree building it"""
+        # make only compares mtimes, so objects from another checkout must never be mistaken for up to date
+        key = str(source_dir.resolve()).encode() + b"\0" + self._read_kconfig(kconfig_path)
+        digest = hashlib.sha1(key).hexdigest()[:12]
+        return (self.obj_cache_dir / firmware_type / digest).resolve()
+
+    def _install_outputs(self, firmware_source: Path, output_paths: list[Path]):
+        """Copy a finished firmware image to every output built from its kconfig"""
+        first, *rest = output_paths
+        _install_file(firmware_source, first)
+        print(f"  ✓ {first.name}")
+        for output_path in rest:
+            _install_file(firmware_source, output_path)
+            print(f"  ✓ {output_path.name} (same kconfig as {first.name})")
+
+    def _megabuild_rule(self, build_dir: Path, source_dir: Path) -> str:
+        """Recipe configuring and compiling one build directory, logging to build.log and stamping .ok on success"""
+
+        def args(*values: Any) -> str:
+            # Shell-quote, then escape $ so make passes it through (e.g. the deferred $(CROSS_PREFIX))
+            return " ".join(shlex.quote(str(value)) for value in values).replace("$", "$$")
+
+        make_vars = [f"OUT={build_dir}/", f"KCONFIG_CONFIG={build_dir / '.config'}"]
+        log = args(build_dir / "build.log")
+        return (
+            f"\t$(MAKE) -C {args(source_dir, *make_vars)} olddefconfig > {log} 2>&1"
+            f" && $(MAKE) -C {args(source_dir, *make_vars, *self._make_vars())} >> {log} 2>&1"
+            f" && touch {args(build_dir / '.ok')}"
+        )
+
+    def _compile_all(
         self,
-        kconfig_path: Path,
-        output_path: Path,
-        source_dir: Path,
-        firmware_type: str,
+        builds: dict[Path, BuildJob],
+        sources: dict[str, Path],
         dry_run: bool = False,
-    ) -> bool:
-        """Compile firmware (Kalico or Katapult) with a given kconfig"""
+        jobs: int | None = None,
+    ) -> dict[Path, bool]:
+        """Compile builds (keyed by build directory) with one make invocation scheduling across all of them"""
+        results = {}
+        pending = {}
+        for build_dir, job in builds.items():
+            if dry_run:
+                for output_path in job.output_paths:
+                    print(f"  [DRY RUN] {output_path.name}")
+                results[build_dir] = True
+                continue
+
+            # Each kconfig keeps its own .config and objects, so reruns are incremental
+            # and permutations never share build state
+            build_dir.mkdir(parents=True, exist_ok=True)
+            # Leave an identical .config untouched so its mtime doesn't make Kalico regenerate autoconf.h
+            kconfig = self._read_kconfig(job.kconfig_path)
+            config_path = build_dir / ".config"
+            if not config_path.exists() or config_path.read_bytes() != kconfig:
+                config_path.write_bytes(kconfig)
+            # A log or stamp from an earlier run must not be reported as this run's result
+            (build_dir / ".ok").unlink(missing_ok=True)
+            (build_dir / "build.log").unlink(missing_ok=True)
+            pending[build_dir] = job
+
+        if not pending:
+            return results
+
+        # One make runs every permutation's sub-make, so its jobserver packs compiles across all
+        # of them; -k keeps the others going when one fails
+        targets = {f"{job.firmware_type}-{build_dir.name}": build_dir for build_dir, job in pending.items()}
+        lines = [f".PHONY: all {' '.join(targets)}", f"all: {' '.join(targets)}"]
+        for target, build_dir in targets.items():
+            lines += [f"{target}:", self._megabuild_rule(build_dir, sources[pending[build_dir].firmware_type])]
+        # Kept with the build directories: it holds local absolute paths and must never be synced
+        makefile = self.obj_cache_dir / "megabuild.mk"
+        makefile.write_text("\n".join(lines) + "\n")
+        # The top-level make only reports its own errors (bad options, failed recipes), so this stays small
+        make_log = self.obj_cache_dir / "megabuild.log"
+
+        print(f"\nCompiling {len(pending)} firmware in one make invocation")
+        sys.stdout.flush()
+        command = ["make", "-s", "-k", "-j", str(jobs) if jobs is not None else self._jobs, "-f", str(makefile), "all"]
+        # Collect each permutation as soon as its stamp appears, so copying finished images
+        # overlaps the compiles still running
         try:
-            if not dry_run:
-                shutil.copy(kconfig_path, source_dir / ".config")
-                subprocess.run(["make", "clean"], cwd=source_dir, check=True, capture_output=True)
-                subprocess.run(
-                    ["make", "-j", str(os.cpu_count() or 1)],
-                    cwd=source_dir,
-                    check=True,
-                    capture_output=True,
-                )
-
-                # Try possible firmware output names based on type
-                if firmware_type == "kalico":
-                    possible_names = ["klipper.bin", "klipper.elf", "klipper.uf2"]
-                else:  # katapult
-                    possible_names = ["deployer.bin", "deployer.elf", "deployer.uf2"]
-
-                for firmware_name in possible_names:
-                    firmware_source = source_dir / "out" / firmware_name
-                    if firmware_source.exists():
-                        shutil.copy(firmware_source, output_path)
-                        print(f"  ✓ {output_path.name}")
-                        return True
-
-                print(f"  ✗ {output_path.name} - no output found")
+            with (
+                make_log.open("wb") as make_stderr,
+                subprocess.Popen(command, env=self._make_env(), stdout=subprocess.DEVNULL, stderr=make_stderr) as make,
+            ):
+                while pending:
+                    try:
+                        make.wait(timeout=self.BUILD_POLL_INTERVAL)
+                        finished = True
+                    except subprocess.TimeoutExpired:
+                        finished = False
+                    for build_dir in [build_dir for build_dir in pending if (build_dir / ".ok").exists()]:
+                        results[build_dir] = self._collect_build(build_dir, pending.pop(build_dir))
+                    if finished:
+                        break
+        except OSError as e:
+            # make itself could not run (e.g. it is not installed); every remaining build fails below
+            print(f"  ✗ make could not be started - {e}")
+        else:
+            if make.returncode:
+                # make states its own errors up front (a usage error is followed by the whole option list)
+                print(f"  make exited with status {make.returncode}:")
+                with make_log.open(errors="replace") as log:
+                    for line in islice(log, self.ERROR_TAIL_LINES):
+                        print(f"      {line.rstrip()}")
+
+        for build_dir, job in pending.items():
+            self._fail_outputs(job.output_paths, "build failed")
+            for line in self._log_tail(build_dir / "build.log"):
+                print(f"      {line}")
+            results[build_dir] = False
+        return results
+
+    def _fail_outputs(self, output_paths: list[Path], reason: str):
+        """Report every output of a failed build and drop images an earlier run left in their place"""
+        first, *rest = output_paths
+        print(f"  ✗ {first.name} - {reason}")
+        for output_path in rest:
+            print(f"  ✗ {output_path.name} (same kconfig as {first.name})")
+        for output_path in output_paths:
+            with suppress(OSError):
+                output_path.unlink(missing_ok=True)
+
+    def _log_tail(self, log_path: Path) -> list[str]:
+        """Last ERROR_TAIL_LINES lines of a build log, streamed so the whole log is never held in memory"""
+        if not log_path.exists():
+            return []
+        with log_path.open(errors="replace") as log:
+            return [line.rstrip("\n") for line in deque(log, maxlen=self.ERROR_TAIL_LINES)]
+
+    def _collect_build(self, build_dir: Path, job: BuildJob) -> bool:
+        """Install a finished build's image to its outputs and the artifact cache"""
+        try:
+            firmware_source = next(
+                (build_dir / name for name in self.FIRMWARE_OUTPUTS[job.firmware_type] if (build_dir / name).exists()),
+                None,
+            )
+            if not firmware_source:
+                self._fail_outputs(job.output_paths, "no output found")
                 return False
 
-            print(f"  [DRY RUN] {output_path.name}")
+            self._install_outputs(firmware_source, job.output_paths)
+            if job.cached_path:
+                # Installed atomically, so an interrupted build can never leave a truncated cache entry
+                try:
+                    self.artifact_cache.mkdir(parents=True, exist_ok=True)
+                    _install_file(firmware_source, job.cached_path)
+                # The outputs are already installed; failing to cache them only costs a later recompile
+                except OSError as e:
+                    print(f"  ⚠ {job.output_paths[0].name} - not cached: {e}")
             return True
-
-        except subprocess.CalledProcessError:
-            print(f"  ✗ {output_path.name} - build failed")
-            return False
+        # A failure installing one image must not abort the builds still running
         except Exception as e:
-            print(f"  ✗ {output_path.name} - {e}")
+            self._fail_outputs(job.output_paths, str(e))
             return False
 
-    def build(self, version: str, kalico_dir: str, katapult_dir: str = "", commit_url: str = "", dry_run: bool = False):
+    def build(
+        self,
+        version: str,
+        kalico_dir: str,
+        katapult_dir: str = "",
+        commit_url: str = "",
+        dry_run: bool = False,
+        jobs: int | None = None,
+    ):
         """Build all firmware targets"""
         kalico_path = Path(kalico_dir).resolve()
         katapult_path = Path(katapult_dir).resolve() if katapult_dir else None
 
+        if self.ccache and not dry_run:
+            print(f"Using ccache ({self.ccache_dir})")
+
         if not dry_run:
             if not kalico_path.exists():
                 print("Error: Kalico directory not found")
@@ -197,16 +580,46 @@ class KalicoBuilder:
         total_builds = 0
         successful_builds = 0
 
+        sources = {"kalico": kalico_path}
+        if katapult_path:
+            sources["katapult"] = katapult_path
+
+        if not dry_run:
+            # Uncommitted changes make a tree's output unidentifiable, so it bypasses the cache
+            self.source_revisions = {
+                firmware_type: revision
+                for firmware_type, source_dir in sources.items()
+                if (revision := self._source_revision(source_dir))
+            }
+            self.toolchain_version = self._toolchain_version()
+        builds = {}
+        # Kconfig each output file is built from. When several permutations name the same file, Kalico
+        # takes the last one (as when each compile overwrote the previous) and Katapult the first (its
+        # existing-file reuse). Only that kconfig is compiled; count each other permutation on its result
+        chosen: dict[Path, tuple[Path, str]] = {}
+        reused = {}
+        # Target metadata entries referencing each firmware file, and the files known to be built
+        owners: dict[Path, list[dict[str, Any]]] = {}
+        built = set()
+        restored = []
+        restoring = False
+        # Build directories of every kconfig this run produced, whether compiled, restored or reused
+        used_dirs = set()
+
         for target in targets:
             target_id = target.get("targetId")
             print(f"\n[{target_id}]")
 
             permutations = self.generate_permutations(target)
+            templates = self._prepare_target(target)
 
             # Add target to metadata in TargetReleaseBundle shape
-            metadata["targets"].append(self._create_target_metadata(target))
+            target_metadata = self._create_target_metadata(target)
+            metadata["targets"].append(target_metadata)
 
             for permutation in permutations:
+                # Permutation values layered over the target's, without merging them into a new dict
+                params = ChainMap(permutation, templates.params)
                 # Build both Kalico and Katapult for each permutation
                 for firmware_type in self.firmware_types:
                     total_builds += 1
@@ -216,32 +629,95 @@ class KalicoBuilder:
                         continue
 
                     # Get filenames
-                    kconfig_filename = self.get_kconfig_filename(target, permutation, firmware_type)
-                    firmware_filename = self.get_firmware_filename(target, permutation, firmware_type)
+                    kconfig_filename = templates.kconfig[firmware_type](params)
+                    firmware_filename = templates.firmware[firmware_type](params)
 
                     kconfig_path = self.kconfigs_dir / kconfig_filename
                     firmware_path = version_dir / firmware_filename
 
-                    if not kconfig_path.exists():
+                    if kconfig_filename not in self.kconfig_names:
                         print(f"  ⚠ {kconfig_filename} - not found")
                         continue
 
+                    owners.setdefault(firmware_path, []).append(target_metadata)
+
                     # For Katapult, check if firmware already exists and reuse it
                     if firmware_type == "katapult" and firmware_path.exists() and not dry_run:
                         print(f"  ↻ {firmware_filename} - reusing existing")
+                        used_dirs.add(self._build_dir(kconfig_path, firmware_type, sources[firmware_type]))
                         successful_builds += 1
+                        built.add(firmware_path)
                         continue
 
-                    # Compile
-                    source_dir = kalico_path if firmware_type == "kalico" else katapult_path
-                    if self.compile_firmware(kconfig_path, firmware_path, source_dir, firmware_type, dry_run):
-                        successful_builds += 1
+                    if firmware_path in chosen:
+                        reused[firmware_path] += 1
+                        if firmware_type == "kalico":
+                            print(f"  ↻ {firmware_filename} - built from {kconfig_filename} instead")
+                            chosen[firmware_path] = (kconfig_path, firmware_type)
+                        else:
+                            print(f"  ↻ {firmware_filename} - reusing")
+                        continue
+
+                    reused[firmware_path] = 0
+                    chosen[firmware_path] = (kconfig_path, firmware_type)
+
+        for firmware_path, (kconfig_path, firmware_type) in chosen.items():
+            # Kept even when restored from the cache, so the next source change recompiles incrementally
+            build_dir = self._build_dir(kconfig_path, firmware_type, sources[firmware_type])
+            used_dirs.add(build_dir)
+            # Firmware already built from this kconfig, source commit and toolchain is copied
+            # from the artifact cache and never reaches make
+            cached_path = self._cached_artifact(kconfig_path, firmware_type) if not dry_run else None
+            if cached_path and cached_path.exists():
+                if not restoring:
+                    print("\nRestoring cached firmware")
+                    restoring = True
+                try:
+                    _install_file(cached_path, firmware_path)
+                # An unreadable cache entry is only a miss; the firmware is compiled below instead
+                except OSError as e:
+                    print(f"  ⚠ {firmware_path.name} - cache unusable, rebuilding: {e}")
+                else:
+                    print(f"  ✓ {firmware_path.name} (cached)")
+                    restored.append(firmware_path)
+                    continue
+
+            # Permutations with byte-identical kconfigs share one build directory and compile
+            if build_dir in builds:
+                builds[build_dir].output_paths.append(firmware_path)
+            else:
+                builds[build_dir] = BuildJob(kconfig_path, firmware_type, [firmware_path], cached_path)
+
+        for firmware_path in restored:
+            successful_builds += 1 + reused[firmware_path]
+            built.add(firmware_path)
+
+        if builds:
+            for build_dir, success in self._compile_all(builds, sources, dry_run, jobs).items():
+                if success:
+                    output_paths = builds[build_dir].output_paths
+                    successful_builds += sum(1 + reused[firmware_path] for firmware_path in output_paths)
+                    built.update(output_paths)
+
+        if not dry_run:
+            self._prune_build_dirs(sources, used_dirs)
+
+        # Store each distinct image once and record its hash so clients can resolve it
+        if not dry_run:
+            for firmware_path in sorted(built):
+                try:
+                    digest = self._store_object(firmware_path)
+                # One image that cannot be stored must not lose the metadata of all the others
+                except OSError as e:
+                    print(f"  ✗ {firmware_path.name} - {e}")
+                    successful_builds -= len(owners[firmware_path])
+                    continue
+                for target_metadata in owners[firmware_path]:
+                    target_metadata.setdefault("sha256", {})[firmware_path.name] = digest
 
         # Save metadata
         metadata_path = version_dir / "metadata.json"
-        with open(metadata_path, "w") as f:
-            json.dump(metadata, f, indent=4)
-            f.write("\n")
+        _write_atomic(metadata_path, _json_dumps(metadata))
 
         print(f"\nBuild: {successful_builds}/{total_builds} successful → {version_dir}")
 
@@ -249,6 +725,37 @@ class KalicoBuilder:
         if not dry_run:
             self.update_build_in_index(version, commit_url)
 
+    def _prune_build_dirs(self, sources: dict[str, Path], used_dirs: set[Path]):
+        """Remove build directories of kconfigs this run did not build, e.g. ones since edited or deleted"""
+        pruned_count = 0
+        # Only firmware types whose source was given; the others were not built and keep their directories
+        for firmware_type in sources:
+            type_dir = self.obj_cache_dir / firmware_type
+            if not type_dir.is_dir():
+                continue
+            for entry in os.scandir(type_dir):
+                if entry.is_dir(follow_symlinks=False) and Path(entry.path).resolve() not in used_dirs:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    pruned_count += 1
+        if pruned_count:
+            print(f"\nPruned {pruned_count} unused build directories from {self.obj_cache_dir}")
+
+    def _store_object(self, firmware_path: Path) -> str:
+        """Move a firmware image into builds/.objects/ by SHA-256 and symlink it back; returns the hash"""
+        objects_dir = self.objects_dir.resolve()
+        if firmware_path.is_symlink() and firmware_path.resolve().parent == objects_dir:
+            return firmware_path.resolve().stem
+
+        digest = hashlib.sha256(firmware_path.read_bytes()).hexdigest()
+        object_path = objects_dir / f"{digest}{firmware_path.suffix}"
+        objects_dir.mkdir(parents=True, exist_ok=True)
+        if object_path.exists():
+            firmware_path.unlink()
+        else:
+            os.replace(firmware_path, object_path)
+        firmware_path.symlink_to(os.path.relpath(object_path, firmware_path.parent.resolve()))
+        return digest
+
     def _create_target_metadata(self, target: dict[str, Any]) -> dict[str, Any]:
         """Create normalized target metadata for TargetReleaseBundle"""
         config = target.get("configuration", {})
@@ -269,11 +776,15 @@ class KalicoBuilder:
 
         return metadata
 
-    def _create_build_entry(self, version: str, commit_url: str = "") -> dict[str, Any]:
-        """Create a build entry with current timestamp"""
+    def _build_timestamp(self) -> str:
+        """Current UTC time formatted as a build date"""
+        return datetime.now(UTC).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+    def _create_build_entry(self, version: str, commit_url: str = "", timestamp: str | None = None) -> dict[str, Any]:
+        """Create a build entry, stamped with the given timestamp or the current time"""
         return {
             "version": version,
-            "buildDate": datetime.now(UTC).replace(microsecond=0).isoformat().replace("+00:00", "Z"),
+            "buildDate": timestamp or self._build_timestamp(),
             "githubCommitUrl": commit_url,
         }
 
@@ -292,7 +803,7 @@ class KalicoBuilder:
             builds.append(build_entry)
 
         # Sort builds by version (newest first)
-        builds.sort(key=lambda x: x.get("version", ""), reverse=True)
+        builds.sort(key=_version_key, reverse=True)
         index["builds"] = builds
         self.save_index(index)
 
@@ -302,20 +813,21 @@ class KalicoBuilder:
             print("Error: builds/ not found")
             sys.exit(1)
 
-        # Load template and existing builds
-        index = self.load_index_template()
-        existing_builds = self.load_index().get("builds", []) if self.index_file.exists() else []
-        by_version = {b.get("version"): b for b in existing_builds if isinstance(b, dict)}
-
-        versions: list[dict[str, Any]] = [
-            by_version.get(entry.name, self._create_build_entry(entry.name))
-            for entry in self.builds_dir.iterdir()
-            if entry.is_dir()
-        ]
-
-        versions.sort(key=lambda x: x.get("version", ""), reverse=True)
-        index["builds"] = versions
-        self.save_index(index)
+        # Load existing builds; the rest of index.json is replaced by the template
+        by_version = {b.get("version"): b for b in self._load_builds() if isinstance(b, dict)}
+
+        # Every entry synthesized by one rebuild shares a single timestamp
+        timestamp = self._build_timestamp()
+        # scandir entries carry their file type, so telling version directories apart needs no stat
+        with os.scandir(self.builds_dir) as entries:
+            versions: list[dict[str, Any]] = [
+                by_version.get(entry.name) or self._create_build_entry(entry.name, timestamp=timestamp)
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")
+            ]
+
+        versions.sort(key=_version_key, reverse=True)
+        self.save_index({**self.load_index_template(), "builds": versions})
         print(f"✓ Rebuilt index with {len(versions)} builds")
 
     def check_configurations(self):
@@ -326,15 +838,17 @@ class KalicoBuilder:
         configurations = index.get("configurations", [])
 
         # Build a set of all permutation IDs defined in configurations
-        defined_ids = {perm.get("id") for config in configurations for perm in config.get("permutations", [])}
+        defined_ids = set(
+            chain.from_iterable(
+                (perm.get("id") for perm in config.get("permutations", [])) for config in configurations
+            )
+        )
 
         # Collect all unique permutation values used across all targets
-        used_values = {
-            value
-            for target in targets
-            for values in target.get("configuration", {}).get("permutations", {}).values()
-            for value in values
-        }
+        used_values = set()
+        for target in targets:
+            for values in target.get("configuration", {}).get("permutations", {}).values():
+                used_values.update(values)
 
         missing_ids = used_values - defined_ids
 
@@ -355,9 +869,11 @@ class KalicoBuilder:
         targets = index.get("targets", [])
 
         missing_kconfigs = []
-        existing_kconfigs = []
+        found_kconfigs = 0
         missing_images = []
         existing_images = []
+        # Listing of each directory holding product images, scanned once rather than stat'ing every image
+        image_dirs: dict[Path, frozenset[str]] = {}
         total_configs = 0
 
         for target in targets:
@@ -371,8 +887,10 @@ class KalicoBuilder:
                 # Remove leading slash if present
                 image_path = product_image_path.lstrip("/")
                 full_image_path = self.root_dir / image_path
+                if full_image_path.parent not in image_dirs:
+                    image_dirs[full_image_path.parent] = self._scan_dir(full_image_path.parent)
 
-                if full_image_path.exists():
+                if full_image_path.name in image_dirs[full_image_path.parent]:
                     existing_images.append(image_path)
                     print(f"  ✓ Image: {image_path}")
                 else:
@@ -380,14 +898,14 @@ class KalicoBuilder:
                     print(f"  ✗ Image: {image_path}")
 
             permutations = self.generate_permutations(target)
+            templates = self._prepare_target(target)
 
             for permutation in permutations:
                 total_configs += 1
-                kconfig_filename = self.get_kconfig_filename(target, permutation)
-                kconfig_path = self.kconfigs_dir / kconfig_filename
+                kconfig_filename = templates.kconfig["kalico"](ChainMap(permutation, templates.params))
 
-                if kconfig_path.exists():
-                    existing_kconfigs.append(kconfig_filename)
+                if kconfig_filename in self.kconfig_names:
+                    found_kconfigs += 1
                     print(f"  ✓ {kconfig_filename}")
                 else:
                     missing_kconfigs.append(kconfig_filename)
@@ -399,10 +917,10 @@ class KalicoBuilder:
         print(f"{'=' * 60}")
         print("Validation Summary:")
 
-        kconfig_pct = len(existing_kconfigs) * 100 // total_configs if total_configs > 0 else 0
+        kconfig_pct = found_kconfigs * 100 // total_configs if total_configs > 0 else 0
         print("\nKconfig Files:")
         print(f"  Total configs required: {total_configs}")
-        print(f"  Found: {len(existing_kconfigs)} ({kconfig_pct}%)")
+        print(f"  Found: {found_kconfigs} ({kconfig_pct}%)")
         print(f"  Missing: {len(missing_kconfigs)} ({100 - kconfig_pct}%)")
 
         total_images = len(existing_images) + len(missing_images)
@@ -444,83 +962,115 @@ class KalicoBuilder:
     def sync_to_s3(self, dry_run: bool = False):
         """Sync index.json, builds/, and images/ directories to S3 bucket with delete"""
         try:
-            s3_client = boto3.client("s3")
+            s3_client = boto3.client("s3", config=Config(max_pool_connections=self.S3_UPLOAD_WORKERS))
             s3_client.head_bucket(Bucket=self.S3_BUCKET)
 
-            uploaded_count = 0
-            total_size = 0
-            local_keys = set()
+            uploads: list[UploadItem] = []
 
             # Upload index.json
             if self.index_file.exists():
-                s3_key = "index.json"
-                local_keys.add(s3_key)
-                file_size = self.index_file.stat().st_size
-                if not dry_run:
-                    s3_client.upload_file(
-                        str(self.index_file),
-                        self.S3_BUCKET,
-                        s3_key,
-                        ExtraArgs={"ContentType": "application/json"},
-                    )
-                uploaded_count += 1
-                total_size += file_size
+                uploads.append(
+                    UploadItem(self.index_file, "index.json", "application/json", self.index_file.stat().st_size, None)
+                )
 
-            # Upload builds/ directory
+            # Upload builds/ directory; out-of-tree build directories (.obj_cache/) are local build state.
+            # Each distinct image in .objects/ is uploaded once and copied server-side to every
+            # builds/<version>/ key that symlinks to it, so existing download URLs keep working.
+            # Objects no version links to any more are dropped, so their S3 copy is deleted below
+            if self.objects_dir.exists():
+                referenced = self._referenced_objects()
+                pruned_count = 0
+                for entry in self._iter_files(self.objects_dir):
+                    if entry.name in referenced:
+                        uploads.append(self._upload_item(Path(entry.path), entry.stat().st_size))
+                        continue
+                    pruned_count += 1
+                    if not dry_run:
+                        os.unlink(entry.path)
+                if pruned_count:
+                    prune_action = "Would prune" if dry_run else "Pruned"
+                    print(f"{prune_action} {pruned_count} unreferenced objects from {self.objects_dir}")
             if self.builds_dir.exists():
-                for file_path in self.builds_dir.rglob("*"):
-                    if file_path.is_file():
-                        s3_key = str(file_path.relative_to(self.root_dir)).replace("\\", "/")
-                        local_keys.add(s3_key)
-                        file_size = file_path.stat().st_size
-
-                        if not dry_run:
-                            s3_client.upload_file(
-                                str(file_path),
-                                self.S3_BUCKET,
-                                s3_key,
-                                ExtraArgs={"ContentType": self._get_content_type(file_path)},
-                            )
-
-                        uploaded_count += 1
-                        total_size += file_size
+                objects_dir = self.objects_dir.resolve()
+                for entry in self._iter_files(self.builds_dir):
+                    copy_source = None
+                    if entry.is_symlink():
+                        target = Path(entry.path).resolve()
+                        if target.parent == objects_dir:
+                            copy_source = self._s3_key(self.objects_dir / target.name)
+                    uploads.append(self._upload_item(Path(entry.path), entry.stat().st_size, copy_source))
 
             # Upload images/ directory
             if self.images_dir.exists():
-                for file_path in self.images_dir.rglob("*"):
-                    if file_path.is_file():
-                        s3_key = str(file_path.relative_to(self.root_dir)).replace("\\", "/")
-                        local_keys.add(s3_key)
-                        file_size = file_path.stat().st_size
-
-                        if not dry_run:
-                            s3_client.upload_file(
-                                str(file_path),
-                                self.S3_BUCKET,
-                                s3_key,
-                                ExtraArgs={"ContentType": self._get_content_type(file_path)},
-                            )
-
-                        uploaded_count += 1
-                        total_size += file_size
+                for entry in self._iter_files(self.images_dir):
+                    uploads.append(self._upload_item(Path(entry.path), entry.stat().st_size))
 
-            # Delete files in S3 that don't exist locally (--delete behavior)
-            deleted_count = 0
+            local_keys = {item.s3_key for item in uploads}
+
+            # ETag and size of every object already in the bucket
+            remote_objects = {}
             paginator = s3_client.get_paginator("list_objects_v2")
             for page in paginator.paginate(Bucket=self.S3_BUCKET):
-                if "Contents" not in page:
-                    continue
+                for obj in page.get("Contents", []):
+                    remote_objects[obj["Key"]] = obj
+
+            # Uploads are bound by round-trip latency, so overlap them; large files go multipart
+            transfer_config = TransferConfig(max_concurrency=10, multipart_threshold=self.S3_MULTIPART_THRESHOLD)
+
+            def upload(item: UploadItem) -> bool:
+                if self._matches_remote(item.file_path, item.file_size, remote_objects.get(item.s3_key)):
+                    return False
+                if dry_run:
+                    return True
+                if item.copy_source:
+                    s3_client.copy_object(
+                        Bucket=self.S3_BUCKET,
+                        Key=item.s3_key,
+                        CopySource={"Bucket": self.S3_BUCKET, "Key": item.copy_source},
+                        ContentType=item.content_type,
+                        MetadataDirective="REPLACE",
+                    )
+                else:
+                    s3_client.upload_file(
+                        str(item.file_path),
+                        self.S3_BUCKET,
+                        item.s3_key,
+                        ExtraArgs={"ContentType": item.content_type},
+                        Config=transfer_config,
+                    )
+                return True
 
-                for obj in page["Contents"]:
-                    s3_key = obj["Key"]
-                    # Only delete files in our managed directories
-                    managed = s3_key.startswith(("builds/", "images/")) or s3_key == "index.json"
-                    if managed and s3_key not in local_keys:
-                        if dry_run:
-                            print(f"Would delete: s3://{self.S3_BUCKET}/{s3_key}")
+            changed_keys = []
+            skipped_count = 0
+            total_size = 0
+            with ThreadPoolExecutor(max_workers=self.S3_UPLOAD_WORKERS) as pool:
+                # Server-side copies need their source object in place, so they run after the uploads
+                direct = [item for item in uploads if not item.copy_source]
+                copies = [item for item in uploads if item.copy_source]
+                for batch in (direct, copies):
+                    futures = {pool.submit(upload, item): item for item in batch}
+                    for future in as_completed(futures):
+                        if future.result():
+                            item = futures[future]
+                            changed_keys.append(item.s3_key)
+                            if not item.copy_source:
+                                total_size += item.file_size
                         else:
-                            s3_client.delete_object(Bucket=self.S3_BUCKET, Key=s3_key)
-                        deleted_count += 1
+                            skipped_count += 1
+            uploaded_count = len(changed_keys)
+
+            # Delete files in S3 that don't exist locally (--delete behavior)
+            deleted_count = 0
+            for s3_key in remote_objects:
+                # Only delete files in our managed directories
+                managed = s3_key.startswith(("builds/", "images/")) or s3_key == "index.json"
+                if managed and s3_key not in local_keys:
+                    if dry_run:
+                        print(f"Would delete: s3://{self.S3_BUCKET}/{s3_key}")
+                    else:
+                        s3_client.delete_object(Bucket=self.S3_BUCKET, Key=s3_key)
+                    changed_keys.append(s3_key)
+                    deleted_count += 1
 
             # Summary
             action = "Would upload" if dry_run else "Uploaded"
@@ -528,10 +1078,12 @@ class KalicoBuilder:
             if deleted_count > 0:
                 delete_action = "Would delete" if dry_run else "Deleted"
                 print(f"{delete_action} {deleted_count} stale files from S3")
+            if skipped_count > 0:
+                print(f"Skipped {skipped_count} unchanged files")
 
             # Invalidate CloudFront
-            if not dry_run and self.CLOUDFRONT_DISTRIBUTION_ID:
-                self._invalidate_cloudfront()
+            if not dry_run and self.CLOUDFRONT_DISTRIBUTION_ID and changed_keys:
+                self._invalidate_cloudfront(changed_keys)
 
         except NoCredentialsError:
             print("Error: AWS credentials not configured")
@@ -540,40 +1092,70 @@ class KalicoBuilder:
             print(f"Error: {e}")
             sys.exit(1)
 
+    def _referenced_objects(self) -> set[str]:
+        """Names of the .objects/ entries that some builds/<version>/ file symlinks to"""
+        objects_dir = self.objects_dir.resolve()
+        referenced = set()
+        for entry in self._iter_files(self.builds_dir):
+            if entry.is_symlink():
+                target = Path(entry.path).resolve()
+                if target.parent == objects_dir:
+                    referenced.add(target.name)
+        return referenced
+
+    def _iter_files(self, root: Path) -> Iterator[os.DirEntry]:
+        """Recursively yield entries for files and symlinks to files; type and stat are cached by scandir"""
+        with os.scandir(root) as entries:
+            for entry in entries:
+                # Hidden entries are local state: .objects/ and .obj_cache/, or leftover .<name>.tmp files
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._iter_files(Path(entry.path))
+                elif entry.is_file():
+                    yield entry
+
+    def _s3_key(self, file_path: Path) -> str:
+        """S3 key of a local file under the root directory"""
+        return str(file_path.relative_to(self.root_dir)).replace("\\", "/")
+
+    def _upload_item(self, file_path: Path, file_size: int, copy_source: str | None = None) -> UploadItem:
+        """Upload work item for a local file"""
+        return UploadItem(file_path, self._s3_key(file_path), self._get_content_type(file_path), file_size, copy_source)
+
+    def _matches_remote(self, file_path: Path, file_size: int, remote: dict[str, Any] | None) -> bool:
+        """Whether an S3 object already holds the same bytes as a local file"""
+        if remote is None or remote["Size"] != file_size:
+            return False
+        etag = remote["ETag"].strip('"')
+        # Multipart ETags ("<md5 of part md5s>-<parts>") are not a content MD5; size is all we can compare
+        if "-" in etag:
+            return True
+        return hashlib.md5(file_path.read_bytes(), usedforsecurity=False).hexdigest() == etag
+
     def _get_content_type(self, file_path: Path) -> str:
         """Determine content type based on file extension"""
-        suffix = file_path.suffix.lower()
-        content_types = {
-            ".json": "application/json",
-            ".bin": "application/octet-stream",
-            ".elf": "application/octet-stream",
-            ".uf2": "application/octet-stream",
-            ".hex": "application/octet-stream",
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".gif": "image/gif",
-            ".svg": "image/svg+xml",
-            ".webp": "image/webp",
-        }
-        return content_types.get(suffix, "application/octet-stream")
+        return self.CONTENT_TYPES.get(file_path.suffix.lower(), "application/octet-stream")
 
     def _format_size(self, size_bytes: int) -> str:
         """Format file size in human-readable format"""
-        for unit in ["B", "KB", "MB", "GB"]:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
-
-    def _invalidate_cloudfront(self):
-        """Invalidate CloudFront cache"""
+        # Each unit spans 10 bits, so the bit length picks the unit without repeated division
+        unit = min(max(size_bytes.bit_length() - 1, 0) // 10, len(self.SIZE_UNITS) - 1)
+        return f"{size_bytes / (1 << (10 * unit)):.1f} {self.SIZE_UNITS[unit]}"
+
+    def _invalidate_cloudfront(self, changed_keys: list[str]):
+        """Invalidate the CloudFront cache for changed keys, or everything if there are too many"""
+        if len(changed_keys) > self.CLOUDFRONT_MAX_PATHS:
+            paths = ["/*"]
+        else:
+            paths = [quote(f"/{s3_key}") for s3_key in sorted(changed_keys)]
+
         try:
             cloudfront = boto3.client("cloudfront")
             response = cloudfront.create_invalidation(
                 DistributionId=self.CLOUDFRONT_DISTRIBUTION_ID,
                 InvalidationBatch={
-                    "Paths": {"Quantity": 1, "Items": ["/*"]},
+                    "Paths": {"Quantity": len(paths), "Items": paths},
                     "CallerReference": f"sync-{datetime.now(UTC).isoformat()}",
                 },
             )
@@ -623,6 +1205,9 @@ Examples:
         default="",
         help="GitHub commit URL for this build (e.g., https://github.com/KalicoCrew/kalico/commit/abc123)",
     )
+    build_parser.add_argument(
+        "--jobs", type=_positive_int, default=None, help="Number of parallel compile jobs (default: CPU count)"
+    )
     build_parser.add_argument("--dry-run", action="store_true", help="Print commands without executing them")
     build_parser.add_argument("--root-dir", default=".", help="Root directory (default: current directory)")
 
@@ -658,7 +1243,7 @@ Examples:
     builder = KalicoBuilder(args.root_dir)
 
     if args.command == "build":
-        builder.build(args.version, args.kalico_dir, args.katapult_dir, args.commit_url, args.dry_run)
+        builder.build(args.version, args.kalico_dir, args.katapult_dir, args.commit_url, args.dry_run, args.jobs)
     elif args.command == "check-configurations":
         builder.check_configurations()
     elif args.command == "validate":